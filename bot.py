@@ -1,6 +1,12 @@
+import asyncio
+import functools
+import heapq
 import json
 import os
+import random
 import re
+from bisect import bisect_right
+from itertools import accumulate
 from dataclasses import dataclass
 from typing import Dict, List, Optional, Tuple
 
@@ -9,6 +15,11 @@ import discord
 from discord import app_commands
 from dotenv import load_dotenv
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 load_dotenv()
 
 DISCORD_TOKEN = os.getenv("DISCORD_TOKEN", "")
@@ -18,6 +29,8 @@ ROLE_COLLECTIONNEUR_ID = int(os.getenv("ROLE_COLLECTIONNEUR_ID", "0"))
 ROLE_COLLECTIONNEUR_ID_NEW_USER = int(os.getenv("ROLE_COLLECTIONNEUR_ID_NEW_USER", "0"))
 HELIUS_API_KEY = os.getenv("HELIUS_API_KEY", "")
 NFT_COLLECTION_NAME = os.getenv("NFT_COLLECTION_NAME", "World Icons Cards")
+HELIUS_PAGE_LIMIT = 100
+HELIUS_MAX_PAGES = 10
 
 BASE_DIR = os.path.dirname(__file__)
 DATA_DIR = os.path.join(BASE_DIR, "data")
@@ -25,11 +38,73 @@ CARDS_PATH = os.path.join(DATA_DIR, "cards.json")
 TIERS_PATH = os.path.join(DATA_DIR, "tiers.json")
 
 
+_WS_RE = re.compile(r"\s+")
+
+
 def normalize(s: str) -> str:
-    return re.sub(r"\s+", " ", (s or "").strip().lower())
+    return _WS_RE.sub(" ", (s or "").strip().lower())
+
+
+# Cible de /verify normalisée une fois à l'import
+_NFT_COLLECTION_NORM = normalize(NFT_COLLECTION_NAME)
+
+
+def items_have_collection(items: list) -> bool:
+    """Cherche la collection cible dans une liste d'assets Helius."""
+    # Dédupliquer les noms de collection avant de normaliser : une seule
+    # normalisation par nom distinct plutôt qu'une par asset
+    collections = set()
+    for it in items:
+        metadata = (it.get("content") or {}).get("metadata") or {}
+        if metadata.get("collection"):
+            collections.add(metadata["collection"])
+        for g in it.get("grouping") or []:
+            if g.get("group_key") == "collection" and g.get("group_value"):
+                collections.add(g["group_value"])
+    return any(_NFT_COLLECTION_NORM in normalize(c) for c in collections)
+
+# Statuts HTTP transitoires qui valent la peine d'être retentés
+_RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+async def fetch_json(
+    session: aiohttp.ClientSession, method: str, url: str, retries: int = 3, **kwargs
+):
+    """Requête JSON avec retries (backoff exponentiel + jitter) sur les erreurs transitoires."""
+    for attempt in range(retries):
+        try:
+            async with session.request(method, url, **kwargs) as resp:
+                if resp.status not in _RETRY_STATUS or attempt == retries - 1:
+                    resp.raise_for_status()
+                    return await resp.json()
+        except asyncio.TimeoutError:
+            if attempt == retries - 1:
+                raise
+        await asyncio.sleep(min(2**attempt, 8) + random.random() * 0.25)
+
+
+def chunk_lines(lines: List[str], limit: int = 1024) -> List[str]:
+    """Découpe des lignes en blocs dont le texte joint reste sous `limit`."""
+    # Longueurs cumulées (+1 pour le saut de ligne) puis découpe par bisect
+    cum = list(accumulate(len(l) + 1 for l in lines))
+    chunks: List[str] = []
+    start = 0
+    base = 0
+    while start < len(lines):
+        end = bisect_right(cum, base + limit)
+        if end <= start:
+            # ligne seule plus longue que la limite : la garder telle quelle
+            end = start + 1
+        chunks.append("\n".join(lines[start:end]))
+        base = cum[end - 1]
+        start = end
+    return chunks
 
 
 def load_json(path: str):
+    if orjson is not None:
+        with open(path, "rb") as f:
+            return orjson.loads(f.read())
     with open(path, "r", encoding="utf-8") as f:
         return json.load(f)
 
@@ -72,24 +147,140 @@ class CardRepository:
         self.tiers_path = tiers_path
         self._cards: List[Card] = []
         self._tiers: List[Tier] = []
+        self._names: List[str] = []
+        self._weights: List[int] = []
+        self._norm_keys: List[str] = []
+        self._norm_names: List[str] = []
+        self._by_norm_key: Dict[str, Card] = {}
+        self._by_norm_name: Dict[str, Card] = {}
+        self._total_weight: int = 0
+        self._probabilities: List[float] = []
+        self._card_index: Dict[Card, int] = {}
+        self._tier_min_asc: List[int] = []
+        self._tier_names_asc: List[str] = []
+        self._card_tier: List[str] = []
+        self._cards_mtime: Optional[float] = None
+        self._tiers_mtime: Optional[float] = None
+        self._loot_lines: List[str] = []
+        self._lootrate_fields: List[Tuple[str, str]] = []
+        self._reload_lock = asyncio.Lock()
         self.reload()
 
+    @staticmethod
+    def _mtime(path: str) -> Optional[float]:
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
+
+    def maybe_reload(self) -> None:
+        """Recharge les JSON seulement si leur mtime a changé."""
+        cards_mtime = self._mtime(self.cards_path)
+        tiers_mtime = self._mtime(self.tiers_path)
+        if cards_mtime != self._cards_mtime or tiers_mtime != self._tiers_mtime:
+            self.reload()
+
+    async def async_maybe_reload(self) -> None:
+        """Comme maybe_reload, mais le parse JSON tourne hors de l'event loop."""
+        async with self._reload_lock:
+            cards_mtime = self._mtime(self.cards_path)
+            tiers_mtime = self._mtime(self.tiers_path)
+            if cards_mtime != self._cards_mtime or tiers_mtime != self._tiers_mtime:
+                await asyncio.to_thread(self.reload)
+
     def reload(self) -> None:
+        # Tout construire en local d'abord : un fichier cassé lève sans rien
+        # modifier, et les mtimes ne sont enregistrés qu'en cas de succès
+        # (sinon le prochain maybe_reload retenterait silencieusement rien)
+        cards_mtime = self._mtime(self.cards_path)
+        tiers_mtime = self._mtime(self.tiers_path)
         raw_cards = load_json(self.cards_path)
-        self._cards = [Card.from_dict(c) for c in raw_cards]
+        cards = [Card.from_dict(c) for c in raw_cards]
+        # Colonnes parallèles : les boucles chaudes ne touchent qu'un champ par carte
+        names = [c.name for c in cards]
+        weights = [c.weight for c in cards]
+        # Normaliser une seule fois au chargement plutôt qu'à chaque recherche
+        norm_keys = [normalize(c.key) for c in cards]
+        norm_names = [normalize(n) for n in names]
+        # En cas de doublon, garder la première carte (même ordre que les scans)
+        by_norm_key: Dict[str, Card] = {}
+        by_norm_name: Dict[str, Card] = {}
+        for c, k, n in zip(cards, norm_keys, norm_names):
+            by_norm_key.setdefault(k, c)
+            by_norm_name.setdefault(n, c)
+        # Poids total et probabilités calculés une fois pour toutes
+        total_weight = sum(max(0, w) for w in weights)
+        probabilities = [
+            (w / total_weight) if total_weight > 0 else 0.0 for w in weights
+        ]
         tiers: List[Tier] = []
         if os.path.exists(self.tiers_path):
             raw_tiers = load_json(self.tiers_path)
             if isinstance(raw_tiers, list):
                 tiers = [Tier.from_dict(t) for t in raw_tiers]
         if not tiers:
-            tiers = self._tiers_from_cards()
+            tiers = self._tiers_from_weights(weights)
         # Trier du min_weight le plus haut au plus bas
-        self._tiers = sorted(tiers, key=lambda t: t.min_weight, reverse=True)
+        tiers = sorted(tiers, key=lambda t: t.min_weight, reverse=True)
+        # Seuils en ordre croissant pour la recherche dichotomique
+        tier_min_asc = [t.min_weight for t in reversed(tiers)]
+        tier_names_asc = [t.name for t in reversed(tiers)]
+        # Tier de chaque carte calculé une fois au chargement
+        card_tier = [
+            self._compute_tier(w, tier_min_asc, tier_names_asc) for w in weights
+        ]
+        # Lignes d'affichage formatées une seule fois, puis champs /lootrate
+        loot_lines = [
+            f"**{n}** : {p * 100:.3f}%" for n, p in zip(names, probabilities)
+        ]
+        lootrate_fields = [
+            ("Toutes les cartes" if i == 0 else "Toutes les cartes (suite)", chunk)
+            for i, chunk in enumerate(chunk_lines(loot_lines))
+        ]
+
+        # Parse réussi : publier le nouvel état d'un bloc
+        self._cards = cards
+        self._names = names
+        self._weights = weights
+        self._norm_keys = norm_keys
+        self._norm_names = norm_names
+        self._by_norm_key = by_norm_key
+        self._by_norm_name = by_norm_name
+        self._total_weight = total_weight
+        self._probabilities = probabilities
+        self._card_index = {c: i for i, c in enumerate(cards)}
+        self._tiers = tiers
+        self._tier_min_asc = tier_min_asc
+        self._tier_names_asc = tier_names_asc
+        self._card_tier = card_tier
+        self._loot_lines = loot_lines
+        self._lootrate_fields = lootrate_fields
+        self._cards_mtime = cards_mtime
+        self._tiers_mtime = tiers_mtime
 
-    def _tiers_from_cards(self) -> List[Tier]:
-        weights = sorted({c.weight for c in self._cards if c.weight > 0}, reverse=True)
-        return [Tier(name=f"Poids >= {w}", min_weight=w) for w in weights]
+    @property
+    def loot_lines(self) -> List[str]:
+        return self._loot_lines
+
+    @property
+    def lootrate_fields(self) -> List[Tuple[str, str]]:
+        return self._lootrate_fields
+
+    def _compute_tier(
+        self,
+        weight: int,
+        tier_min_asc: Optional[List[int]] = None,
+        tier_names_asc: Optional[List[str]] = None,
+    ) -> str:
+        mins = self._tier_min_asc if tier_min_asc is None else tier_min_asc
+        names = self._tier_names_asc if tier_names_asc is None else tier_names_asc
+        i = bisect_right(mins, weight) - 1
+        return names[i] if i >= 0 else "Inconnu"
+
+    @staticmethod
+    def _tiers_from_weights(weights: List[int]) -> List[Tier]:
+        distinct = sorted({w for w in weights if w > 0}, reverse=True)
+        return [Tier(name=f"Poids >= {w}", min_weight=w) for w in distinct]
 
     @property
     def cards(self) -> List[Card]:
@@ -100,69 +291,56 @@ class CardRepository:
         return self._tiers
 
     def total_weight(self) -> int:
-        return sum(max(0, c.weight) for c in self._cards)
+        return self._total_weight
 
     def probability(self, card: Card) -> float:
-        total = self.total_weight()
-        return (card.weight / total) if total > 0 else 0.0
+        i = self._card_index.get(card)
+        if i is not None:
+            return self._probabilities[i]
+        return (card.weight / self._total_weight) if self._total_weight > 0 else 0.0
 
     def tier_for_card(self, card: Card) -> str:
-        w = card.weight
-        for t in self._tiers:
-            if w >= t.min_weight:
-                return t.name
-        return "Inconnu"
+        i = self._card_index.get(card)
+        if i is not None:
+            return self._card_tier[i]
+        return self._compute_tier(card.weight)
 
     def summary_by_tier(self) -> Dict[str, Tuple[int, float]]:
         """
         returns: { tier_name: (sum_weight, pct) }
         """
         total = self.total_weight()
-        sums: Dict[str, int] = {}
-        for c in self._cards:
-            tier = self.tier_for_card(c)
-            sums[tier] = sums.get(tier, 0) + max(0, c.weight)
-
-        out: Dict[str, Tuple[int, float]] = {}
-        for tier, wsum in sums.items():
-            pct = (wsum / total * 100) if total > 0 else 0.0
-            out[tier] = (wsum, pct)
-
-        # garder un ordre cohérent = ordre tiers.json
-        ordered: Dict[str, Tuple[int, float]] = {}
-        for t in self._tiers:
-            if t.name in out:
-                ordered[t.name] = out[t.name]
-        # ajouter les éventuels tiers inconnus
-        for k, v in out.items():
-            if k not in ordered:
-                ordered[k] = v
-        return ordered
+        # Pré-amorcer dans l'ordre tiers.json : plus besoin de réordonner après
+        sums: Dict[str, int] = {t.name: 0 for t in self._tiers}
+        seen = set()
+        for tier, w in zip(self._card_tier, self._weights):
+            sums[tier] = sums.get(tier, 0) + max(0, w)
+            seen.add(tier)
+        return {
+            tier: (wsum, (wsum / total * 100) if total > 0 else 0.0)
+            for tier, wsum in sums.items()
+            if tier in seen
+        }
 
     def find_card(self, query: str) -> Optional[Card]:
         q = normalize(query)
         if not q:
             return None
 
-        # match exact sur key
-        for c in self._cards:
-            if normalize(c.key) == q:
-                return c
-
-        # match exact sur name
-        for c in self._cards:
-            if normalize(c.name) == q:
-                return c
+        # match exact sur key ou name : O(1)
+        card = self._by_norm_key.get(q) or self._by_norm_name.get(q)
+        if card:
+            return card
 
         # match partiel sur name
-        for c in self._cards:
-            if q in normalize(c.name):
+        for c, n in zip(self._cards, self._norm_names):
+            if q in n:
                 return c
 
         return None
 
     def top_cards(self, n: int = 10) -> List[Card]:
-        return sorted(self._cards, key=lambda c: c.weight, reverse=True)[: max(1, n)]
+        return heapq.nlargest(max(1, n), self._cards, key=lambda c: c.weight)
 
 
 # --------- Discord setup ----------
@@ -177,31 +355,53 @@ class WorldIconsBot(discord.Client):
     def __init__(self):
         super().__init__(intents=intents)
         self.tree = app_commands.CommandTree(self)
+        self.http_session: Optional[aiohttp.ClientSession] = None
+        # Rôle auto-attribué par guild, résolu une fois dans on_ready
+        self._auto_roles: Dict[int, Optional[discord.Role]] = {}
 
     async def setup_hook(self):
+        # Session partagée : une seule négociation TCP/TLS, keep-alive ensuite
+        self.http_session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=15)
+        )
         if GUILD_ID:
             guild = discord.Object(id=GUILD_ID)
             self.tree.copy_global_to(guild=guild)
             await self.tree.sync(guild=guild)
 
+    async def close(self):
+        if self.http_session:
+            await self.http_session.close()
+        await super().close()
+
 
 bot = WorldIconsBot()
 
 
+def with_repo(fn):
+    """Recharge les données (si besoin) et gère l'erreur avant la commande."""
+
+    @functools.wraps(fn)
+    async def wrapper(interaction: discord.Interaction, *args, **kwargs):
+        try:
+            await repo.async_maybe_reload()
+        except Exception as e:
+            await interaction.response.send_message(
+                f"Erreur données: `{e}`", ephemeral=True
+            )
+            return
+        await fn(interaction, *args, **kwargs)
+
+    return wrapper
+
+
 # ---------- /lootrate ----------
 @bot.tree.command(
     name="lootrate",
     description="Affiche les taux (probabilités) calculés depuis les poids des cartes.",
 )
+@with_repo
 async def lootrate(interaction: discord.Interaction):
-    try:
-        repo.reload()
-    except Exception as e:
-        await interaction.response.send_message(
-            f"Erreur données: `{e}`", ephemeral=True
-        )
-        return
-
     total = repo.total_weight()
     if total <= 0:
         await interaction.response.send_message(
@@ -212,31 +412,9 @@ async def lootrate(interaction: discord.Interaction):
 
     embed = discord.Embed(title="Taux de loot : ")
 
-    # Toutes les cartes
-    all_cards = repo.cards
-    all_lines = []
-    for c in all_cards:
-        p = repo.probability(c) * 100
-        all_lines.append(f"**{c.name}** : {p:.3f}%")
-
-    field_chunks = []
-    current = []
-    current_len = 0
-    for line in all_lines:
-        line_len = len(line) + 1
-        if current and current_len + line_len > 1024:
-            field_chunks.append(current)
-            current = [line]
-            current_len = line_len
-        else:
-            current.append(line)
-            current_len += line_len
-    if current:
-        field_chunks.append(current)
-
-    for i, chunk in enumerate(field_chunks):
-        name = "Toutes les cartes" if i == 0 else "Toutes les cartes (suite)"
-        embed.add_field(name=name, value="\n".join(chunk), inline=False)
+    # Champs pré-calculés au reload : rien à formater ici
+    for name, value in repo.lootrate_fields:
+        embed.add_field(name=name, value=value, inline=False)
     embed.set_footer(text="World Icons Cards - /lootrate")
 
     await interaction.response.send_message(embed=embed)
@@ -248,15 +426,8 @@ async def lootrate(interaction: discord.Interaction):
     description="Affiche les détails d'une carte (poids + proba + image).",
 )
 @app_commands.describe(nom_carte="Nom (complet ou partiel) ou key de la carte")
+@with_repo
 async def cardinfo(interaction: discord.Interaction, nom_carte: str):
-    try:
-        repo.reload()
-    except Exception as e:
-        await interaction.response.send_message(
-            f"Erreur données: `{e}`", ephemeral=True
-        )
-        return
-
     card = repo.find_card(nom_carte)
     if not card:
         await interaction.response.send_message(
@@ -289,16 +460,12 @@ async def sui(interaction: discord.Interaction, devise: str = "eur"):
     params = {"ids": "sui,solana", "vs_currencies": devise}
 
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, params=params, timeout=10) as resp:
-                if resp.status != 200:
-                    text = await resp.text()
-                    await interaction.response.send_message(
-                        f"CoinGecko error HTTP {resp.status}: {text[:200]}",
-                        ephemeral=True,
-                    )
-                    return
-                data = await resp.json()
+        data = await fetch_json(bot.http_session, "GET", url, params=params)
+    except aiohttp.ClientResponseError as e:
+        await interaction.response.send_message(
+            f"CoinGecko error HTTP {e.status}: {e.message}", ephemeral=True
+        )
+        return
     except Exception as e:
         await interaction.response.send_message(f"Erreur API: `{e}`", ephemeral=True)
         return
@@ -341,42 +508,37 @@ async def verify(interaction: discord.Interaction, wallet: str):
         return
 
     url = f"https://mainnet.helius-rpc.com/?api-key={HELIUS_API_KEY}"
-    payload = {
-        "jsonrpc": "2.0",
-        "id": "wic-verify",
-        "method": "getAssetsByOwner",
-        "params": {"ownerAddress": wallet, "page": 1, "limit": 100},
-    }
+
+    async def fetch_page(page: int) -> list:
+        payload = {
+            "jsonrpc": "2.0",
+            "id": "wic-verify",
+            "method": "getAssetsByOwner",
+            "params": {
+                "ownerAddress": wallet,
+                "page": page,
+                "limit": HELIUS_PAGE_LIMIT,
+            },
+        }
+        data = await fetch_json(bot.http_session, "POST", url, json=payload)
+        return (data.get("result", {}) or {}).get("items", []) or []
 
     await interaction.response.defer(ephemeral=True)
 
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, json=payload, timeout=15) as resp:
-                data = await resp.json()
+        items = await fetch_page(1)
+        found = items_have_collection(items)
+        # Pas de match et page pleine = il y a peut-être d'autres pages :
+        # les charger en parallèle (inutile si la page 1 a déjà trouvé)
+        if not found and len(items) == HELIUS_PAGE_LIMIT:
+            extra_pages = await asyncio.gather(
+                *(fetch_page(p) for p in range(2, HELIUS_MAX_PAGES + 1))
+            )
+            found = any(items_have_collection(p) for p in extra_pages)
     except Exception as e:
         await interaction.followup.send(f"Erreur Helius: `{e}`", ephemeral=True)
         return
 
-    items = (data.get("result", {}) or {}).get("items", []) or []
-
-    found = False
-    for it in items:
-        content = it.get("content", {}) or {}
-        metadata = content.get("metadata", {}) or {}
-
-        collection_name = metadata.get("collection") or ""
-        if not collection_name:
-            grouping = it.get("grouping", []) or []
-            for g in grouping:
-                if g.get("group_key") == "collection":
-                    collection_name = g.get("group_value") or ""
-                    break
-
-        if normalize(NFT_COLLECTION_NAME) in normalize(collection_name):
-            found = True
-            break
-
     if not found:
         await interaction.followup.send(
             "Je n'ai pas trouvé de NFT de la collection sur ce wallet (selon les données renvoyées).",
@@ -417,6 +579,9 @@ async def verify(interaction: discord.Interaction, wallet: str):
 @bot.event
 async def on_ready():
     print(f"Connecté en tant que {bot.user} (ID: {bot.user.id})")
+    if ROLE_COLLECTIONNEUR_ID_NEW_USER:
+        for guild in bot.guilds:
+            bot._auto_roles[guild.id] = guild.get_role(ROLE_COLLECTIONNEUR_ID_NEW_USER)
 
 
 @bot.event
@@ -424,7 +589,11 @@ async def on_member_join(member: discord.Member):
     if not ROLE_COLLECTIONNEUR_ID_NEW_USER:
         return
 
-    role = member.guild.get_role(ROLE_COLLECTIONNEUR_ID_NEW_USER)
+    role = bot._auto_roles.get(member.guild.id)
+    if role is None:
+        # Pas encore en cache, ou rôle créé depuis : re-résoudre
+        role = member.guild.get_role(ROLE_COLLECTIONNEUR_ID_NEW_USER)
+        bot._auto_roles[member.guild.id] = role
     if not role:
         return
 
@@ -432,6 +601,10 @@ async def on_member_join(member: discord.Member):
         await member.add_roles(role, reason="Auto assign Collectionneur role")
     except discord.Forbidden:
         return
+    except discord.HTTPException:
+        # Rôle probablement supprimé entre-temps : invalider le cache
+        bot._auto_roles.pop(member.guild.id, None)
+        return
 
 
 if __name__ == "__main__":